@@ -1,22 +1,46 @@
 #!/usr/bin/python3
 import argparse
-import requests
+import os
 import re
-import magic
+import sys
+import tempfile
+import time
 
+# JSON bodies are serialized to bytes and sent as they are, so the HTTP client doesn't encode them again
 try:
-    import ujson as json
+    import orjson
+
+    def json_dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+
+    def json_dumps_pretty(obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+
+    json_loads = orjson.loads
 except (ImportError, SyntaxError):
     try:
-        import simplejson as json
+        import ujson as json
     except (ImportError, SyntaxError):
-        import json
+        try:
+            import simplejson as json
+        except (ImportError, SyntaxError):
+            import json
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode("UTF-8")
+
+    def json_dumps_pretty(obj) -> bytes:
+        return json.dumps(obj, indent=2).encode("UTF-8")
+
+    json_loads = json.loads
 
 from argparse import HelpFormatter
-from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
 
 from datetime import datetime, timezone
-from typing import List, Dict
+from typing import Iterator, List, Dict, Optional, Tuple
 
 
 class CustomHelpFormatter(HelpFormatter):
@@ -53,95 +77,215 @@ https://github.com/alex1701c/Screenshots/blob/master/PythonArgparseCLI/default_o
 https://github.com/alex1701c/Screenshots/blob/master/PythonArgparseCLI/customized_output_format.png
 """
 
+# Shared HTTP client, so all API calls go over one (HTTP/2 multiplexed) connection to bsky.social.
+# It is created by create_client() after the arguments are parsed, so --help and --version
+# don't pay for importing httpx.
+CLIENT = None
 
-def parse_tags(text: str) -> List[Dict]:
-    spans = []
-    # regex based on: https://stackoverflow.com/questions/38506598/regular-expression-to-match-hashtag-but-not-hashtag-with-semicolon
-    mention_regex = rb"[$|\W]\B(\#[a-zA-Z0-9]+\b)(?!;)"
-    text_bytes = text.encode("UTF-8")
-    for m in re.finditer(mention_regex, text_bytes):
-        spans.append({
-            "start": m.start(1),
-            "end": m.end(1),
-            "tag": m.group(1)[1:].decode("UTF-8")
-        })
-    return spans
+RESOLVE_URL = "/xrpc/com.atproto.identity.resolveHandle"
+UPLOAD_URL = "/xrpc/com.atproto.repo.uploadBlob"
 
+# createRecord body for a post, copied and filled in for each post
+_CREATE_TEMPLATE = {"repo": None, "collection": "app.bsky.feed.post", "record": None}
 
-def parse_mentions(text: str) -> List[Dict]:
-    spans = []
-    # regex based on: https://atproto.com/specs/handle#handle-identifier-syntax
-    mention_regex = rb"[$|\W](@([a-zA-Z0-9]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?)"
-    text_bytes = text.encode("UTF-8")
-    for m in re.finditer(mention_regex, text_bytes):
-        spans.append({
-            "start": m.start(1),
-            "end": m.end(1),
-            "handle": m.group(1)[1:].decode("UTF-8")
-        })
-    return spans
+# On-disk cache of resolved handles, {handle: [did, resolved_at]},
+# loaded by get_did_cache() only when a post mentions any handles
+_did_cache = None
+_CACHE_TTL = 86400
 
+# libmagic cookie and database are loaded once and reused for every image,
+# only when the post has any images
+_MIME = None
+
+# regex based on: https://stackoverflow.com/questions/38506598/regular-expression-to-match-hashtag-but-not-hashtag-with-semicolon
+_TAG_RE = re.compile(rb"[$|\W]\B(\#[a-zA-Z0-9]+\b)(?!;)")
+# regex based on: https://atproto.com/specs/handle#handle-identifier-syntax
+_MENTION_PATTERN = rb"@(?:[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?"
+# partial/naive URL regex based on: https://stackoverflow.com/a/3809435
+# tweaked to disallow some training punctuation; the optional "www." prefix is already
+# covered by the host part, so it is not matched separately to avoid ambiguous backtracking
+_URL_PATTERN = rb"https?://[-a-zA-Z0-9@:%._+~#=]{1,256}\.[a-zA-Z0-9()]{1,6}\b(?:[-a-zA-Z0-9()@:%_+.~#?&/=]*[-a-zA-Z0-9@%_+~#/=])?"
+# mentions and URLs in one alternation, so parse_facets scans the text only once
+_FACET_RE = re.compile(
+    rb"[$|\W](?:(?P<mention>" + _MENTION_PATTERN + rb")|(?P<url>" + _URL_PATTERN + rb"))")
+
+
+def create_client():
+    import httpx
+
+    # HTTP/2 needs the optional h2 package (httpx[http2]), use HTTP/1.1 keep-alive without it
+    try:
+        import h2  # noqa: F401
+        http2 = True
+    except ImportError:
+        http2 = False
+
+    return httpx.Client(
+        http2=http2,
+        base_url="https://bsky.social",
+        headers={"User-Agent": "bskypost/1.4"},
+        limits=httpx.Limits(max_connections=10),
+        # no timeout, as with requests before: a timed out createRecord may still have created
+        # the post, and slow uploads sharing one connection shouldn't fail on the 5 s default
+        timeout=None,
+    )
 
-def parse_urls(text: str) -> List[Dict]:
-    spans = []
-    # partial/naive URL regex based on: https://stackoverflow.com/a/3809435
-    # tweaked to disallow some training punctuation
-    url_regex = rb"[$|\W](https?:\/\/(www\.)?[-a-zA-Z0-9@:%._\+~#=]{1,256}\.[a-zA-Z0-9()]{1,6}\b([-a-zA-Z0-9()@:%_\+.~#?&//=]*[-a-zA-Z0-9@%_\+~#//=])?)"
-    text_bytes = text.encode("UTF-8")
-    for m in re.finditer(url_regex, text_bytes):
-        spans.append({
-            "start": m.start(1),
-            "end": m.end(1),
-            "url": m.group(1).decode("UTF-8"),
-        })
-    return spans
+
+def parse_tags(text_bytes: bytes) -> Iterator[Tuple[int, int, str]]:
+    for m in _TAG_RE.finditer(text_bytes):
+        yield m.start(1), m.end(1), m.group(1)[1:].decode("UTF-8")
+
+
+# Mention and URL spans (kind, start, end, value) from a single scan, in order of appearance
+def parse_facet_spans(text_bytes: bytes) -> Iterator[Tuple[str, int, int, str]]:
+    for m in _FACET_RE.finditer(text_bytes):
+        # "mention" spans carry the handle without "@", "url" spans the whole URL
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == "mention":
+            value = value[1:]
+        yield kind, m.start(kind), m.end(kind), value.decode("UTF-8")
+
+
+# Resolve a handle to its DID, None if the handle can't be resolved
+@lru_cache(maxsize=None)
+def resolve_handle(handle: str) -> Optional[str]:
+    resp = CLIENT.get(RESOLVE_URL, params={"handle": handle})
+    # If the handle can't be resolved, just skip it!
+    # It will be rendered as text in the post instead of a link
+    if resp.status_code == 400:
+        return None
+    return json_loads(resp.content)["did"]
+
+
+# Path of the handle cache, an empty XDG_CACHE_HOME counts as unset (as the XDG spec says)
+def did_cache_path() -> Path:
+    return Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "bskypost" / "handles.json"
+
+
+# Load the still valid entries of the handle cache, empty cache if it is missing or broken
+def load_did_cache() -> Dict[str, List]:
+    now = time.time()
+    try:
+        with open(did_cache_path(), "rb") as f:
+            cache = json_loads(f.read())
+        return {h: v for h, v in cache.items() if now - v[1] <= _CACHE_TTL}
+    except (OSError, RuntimeError, ValueError, TypeError, LookupError, AttributeError):
+        return {}
+
+
+# Atomically write the handle cache, the cache is best effort so failures are ignored
+def save_did_cache(cache: Dict[str, List]) -> None:
+    try:
+        path = did_cache_path()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # every writer gets its own temporary file, so concurrent runs don't clobber each other
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix="handles.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(json_dumps(cache))
+            os.replace(tmp, path)
+        except OSError:
+            os.unlink(tmp)
+            raise
+    except (OSError, RuntimeError):
+        pass
+
+
+def get_did_cache() -> Dict[str, List]:
+    global _did_cache
+    if _did_cache is None:
+        _did_cache = load_did_cache()
+    return _did_cache
+
+
+# Upload image file as a blob and return its app.bsky.embed.images entry
+def upload_image(img: str, alt: str) -> Dict:
+    # TODO: strip EXIF metadata here, if needed
+
+    with open(img, 'rb') as f:
+        # the file header is enough to detect the MIME type,
+        # the file itself is streamed to the upload request
+        mime = _MIME.from_buffer(f.read(2048))
+        f.seek(0)
+        resp = CLIENT.post(
+            UPLOAD_URL,
+            headers={
+                "Content-Type": mime,
+            },
+            content=f,
+        )
+    resp.raise_for_status()
+    return {
+        'alt': alt,
+        'image': json_loads(resp.content)["blob"]
+    }
 
 # Parse facets from text and resolve the handles to DIDs
 
 
 def parse_facets(text: str) -> List[Dict]:
+    # Scanners are run only for the markers present in the text,
+    # plain text without any of them isn't encoded and scanned at all
+    has_spans = "@" in text or "://" in text
+    has_tags = "#" in text
+    if not has_spans and not has_tags:
+        return []
     facets = []
-    for m in parse_mentions(text):
-        resp = requests.get(
-            "https://bsky.social/xrpc/com.atproto.identity.resolveHandle",
-            params={"handle": m["handle"]},
-        )
-        # If the handle can't be resolved, just skip it!
-        # It will be rendered as text in the post instead of a link
-        if resp.status_code == 400:
-            continue
-        did = resp.json()["did"]
-        facets.append({
-            "index": {
-                "byteStart": m["start"],
-                "byteEnd": m["end"],
-            },
-            "features": [{"$type": "app.bsky.richtext.facet#mention", "did": did}],
-        })
-    for u in parse_urls(text):
-        facets.append({
-            "index": {
-                "byteStart": u["start"],
-                "byteEnd": u["end"],
-            },
-            "features": [
-                {
-                    "$type": "app.bsky.richtext.facet#link",
-                    # NOTE: URI ("I") not URL ("L")
-                    "uri": u["url"],
-                }
-            ],
-        })
-    for t in parse_tags(text):
+    # Encode the text only once, the byte offsets of all facets are based on it
+    text_bytes = text.encode("UTF-8")
+    spans = list(parse_facet_spans(text_bytes)) if has_spans else []
+    # Resolve each distinct handle only once, with the lookups running concurrently
+    handles = {value for kind, _, _, value in spans if kind == "mention"}
+    did_map = {}
+    if handles:
+        did_cache = get_did_cache()
+        did_map = {h: did_cache[h][0] for h in handles if h in did_cache}
+        missing = handles - did_map.keys()
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(8, len(missing))) as ex:
+                resolved = dict(zip(missing, ex.map(resolve_handle, missing)))
+            did_map.update(resolved)
+            now = time.time()
+            did_cache.update({h: [did, now] for h, did in resolved.items() if did is not None})
+            save_did_cache(did_cache)
+    for kind, start, end, value in spans:
+        if kind == "mention":
+            did = did_map[value]
+            if did is None:
+                continue
+            facets.append({
+                "index": {
+                    "byteStart": start,
+                    "byteEnd": end,
+                },
+                "features": [{"$type": "app.bsky.richtext.facet#mention", "did": did}],
+            })
+        else:
+            facets.append({
+                "index": {
+                    "byteStart": start,
+                    "byteEnd": end,
+                },
+                "features": [
+                    {
+                        "$type": "app.bsky.richtext.facet#link",
+                        # NOTE: URI ("I") not URL ("L")
+                        "uri": value,
+                    }
+                ],
+            })
+    tags = parse_tags(text_bytes) if has_tags else ()
+    for start, end, tag in tags:
         facets.append({
             "index": {
-                "byteStart": t["start"],
-                "byteEnd": t["end"],
+                "byteStart": start,
+                "byteEnd": end,
             },
             "features": [
                 {
                     "$type": "app.bsky.richtext.facet#tag",
-                    "tag": t["tag"],
+                    "tag": tag,
                 }
             ],
         })
@@ -166,69 +310,63 @@ if __name__ == "__main__":
     parser.add_argument('post_text', metavar='<post_text>', help='Post text')
     args = parser.parse_args()
 
-    now = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
-
-    resp = requests.post(
-        "https://bsky.social/xrpc/com.atproto.server.createSession",
-        json={"identifier": args.bsky_handle, "password": args.app_password},
-    )
-    resp.raise_for_status()
-    session = resp.json()
-    # print(session["accessJwt"])
-
-    post = {
-        "$type": "app.bsky.feed.post",
-        "text": args.post_text,
-        "createdAt": now,
-    }
-
-    post["facets"] = parse_facets(post["text"])
-
+    CLIENT = create_client()
     if args.image:
-        post["embed"] = {
-            "$type": "app.bsky.embed.images",
-            "images": []
-        }
-
-        for idx, img in enumerate(args.image):
-            with open(img, 'rb') as f:
-                img_bytes = f.read()
+        import magic
+        _MIME = magic.Magic(mime=True)
 
-            # this size limit is specified in the app.bsky.embed.images lexicon
-            if len(img_bytes) > 1000000:
-                raise Exception(
-                    f"image file {img} size is too large. 1000000 bytes maximum, got: {len(img_bytes)}"
-                )
+    now = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
 
-            # TODO: strip EXIF metadata here, if needed
-
-            resp = requests.post(
-                "https://bsky.social/xrpc/com.atproto.repo.uploadBlob",
-                headers={
-                    "Content-Type": magic.from_buffer(img_bytes, mime=True),
-                    "Authorization": "Bearer " + session["accessJwt"],
-                },
-                data=img_bytes,
-            )
-            resp.raise_for_status()
-            blob = resp.json()["blob"]
-
-            post["embed"]["images"].append({
-                'alt': args.alt[idx] if len(args.alt) > idx else "",
-                'image': blob
-            })
+    with CLIENT:
+        resp = CLIENT.post(
+            "/xrpc/com.atproto.server.createSession",
+            headers={"Content-Type": "application/json"},
+            content=json_dumps({"identifier": args.bsky_handle, "password": args.app_password}),
+        )
+        resp.raise_for_status()
+        session = json_loads(resp.content)
+        # print(session["accessJwt"])
+        CLIENT.headers["Authorization"] = "Bearer " + session["accessJwt"]
+
+        post = {
+            "$type": "app.bsky.feed.post",
+            "text": args.post_text,
+            "createdAt": now,
+        }
 
-    if args.lang:
-        post['langs'] = args.lang
-
-    resp = requests.post(
-        "https://bsky.social/xrpc/com.atproto.repo.createRecord",
-        headers={"Authorization": "Bearer " + session["accessJwt"]},
-        json={
-            "repo": session["did"],
-            "collection": "app.bsky.feed.post",
-            "record": post,
-        },
-    )
-    print(json.dumps(resp.json(), indent=2))
-    resp.raise_for_status()
+        post["facets"] = parse_facets(post["text"])
+
+        if args.image:
+            for img in args.image:
+                # this size limit is specified in the app.bsky.embed.images lexicon
+                size = os.path.getsize(img)
+                if size > 1000000:
+                    raise Exception(
+                        f"image file {img} size is too large. 1000000 bytes maximum, got: {size}"
+                    )
+
+            # --alt may be omitted or given a different number of times than --image
+            alts = (args.alt or [])[:len(args.image)]
+            alts += [""] * (len(args.image) - len(alts))
+            # Upload the images concurrently, map() keeps them in the order they were given
+            with ThreadPoolExecutor(max_workers=min(4, len(args.image))) as ex:
+                images = list(ex.map(upload_image, args.image, alts))
+
+            post["embed"] = {
+                "$type": "app.bsky.embed.images",
+                "images": images
+            }
+
+        if args.lang:
+            post['langs'] = args.lang
+
+        body = _CREATE_TEMPLATE.copy()
+        body["repo"] = session["did"]
+        body["record"] = post
+        resp = CLIENT.post(
+            "/xrpc/com.atproto.repo.createRecord",
+            headers={"Content-Type": "application/json"},
+            content=json_dumps(body),
+        )
+        resp.raise_for_status()
+        sys.stdout.buffer.write(json_dumps_pretty(json_loads(resp.content)) + b"\n")